@@ -0,0 +1,275 @@
+import collections
+import weakref
+
+import sqlalchemy as sql
+from models import User, Keyword
+
+
+# natural keys cached for each mapped class, besides the primary key
+NATURAL_KEYS = {
+    User: ('name',),
+    Keyword: ('keyword',),
+}
+
+
+class _Pending:
+    """Work a session has done against the cache in its transaction."""
+
+    def __init__(self):
+        # (class, pk tuple, column state, natural key or None)
+        self.entries = []
+        # cache keys touched by this session's flushes
+        self.invalidated = set()
+
+
+class IdentityCache:
+    """Second-level cache shared by many sessions.
+
+    Stores the column state of ``User`` and ``Keyword`` rows keyed by
+    primary key, plus an index from natural keys (``User.name``,
+    ``Keyword.keyword``) to primary keys. Cached rows are rehydrated into
+    any session as persistent objects without emitting SQL; relationships
+    are still lazy loaded on first access.
+
+    Only committed data reaches other sessions: rows loaded by a session
+    are published when its outermost transaction commits, together with
+    the invalidations of the rows it flushed, and are thrown away if it
+    rolls back. A row is not published if another session committed a
+    change to it after the loading transaction began. Bulk
+    ``Query.update()``/``Query.delete()`` calls bypass the unit of work and
+    are *not* seen by the cache.
+    """
+
+    def __init__(self, maxsize=256, natural_keys=None):
+        self.maxsize = maxsize
+        self.natural_keys = dict(NATURAL_KEYS if natural_keys is None
+                                 else natural_keys)
+        # (class, pk tuple) -> {column key: value}, in LRU order
+        self._states = collections.OrderedDict()
+        # (class, attribute, value) -> pk tuple
+        self._index = {}
+        # number of commits that invalidated something, the value of it
+        # when each open transaction began, and the commit that last
+        # invalidated each key; keys are forgotten once every open
+        # transaction began after that commit
+        self._commits = 0
+        self._began = weakref.WeakKeyDictionary()
+        self._invalidated = {}
+        self._pending = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._states),
+            'hit_rate': self.hit_rate,
+        }
+
+    def install(self, target):
+        """Listen for transaction events on a session or sessionmaker."""
+        sql.event.listen(target, 'after_begin', self._after_begin)
+        sql.event.listen(target, 'after_flush', self._after_flush)
+        sql.event.listen(target, 'after_commit', self._after_commit)
+        sql.event.listen(target, 'after_soft_rollback',
+                         self._after_soft_rollback)
+        sql.event.listen(target, 'after_transaction_end',
+                         self._after_transaction_end)
+
+    def get(self, session, cls, ident):
+        """Cached equivalent of ``session.query(cls).get(ident)``."""
+        pk = ident if isinstance(ident, tuple) else (ident,)
+        obj = self._load(session, cls, pk)
+        if obj is not None:
+            self.hits += 1
+            return obj
+
+        self.misses += 1
+        obj = session.query(cls).get(ident)
+        if obj is not None:
+            self._store(session, obj, None)
+        return obj
+
+    def get_by(self, session, cls, **kwargs):
+        """Cached equivalent of
+        ``session.query(cls).filter_by(attr=value).one_or_none()``.
+        """
+        if len(kwargs) != 1:
+            raise TypeError('get_by() takes exactly one natural key')
+        (attr, value), = kwargs.items()
+        if attr not in self.natural_keys.get(cls, ()):
+            raise KeyError('{}.{} is not a cached natural key'.format(
+                cls.__name__, attr))
+
+        pk = self._index.get((cls, attr, value))
+        if pk is not None:
+            obj = self._load(session, cls, pk)
+            if obj is not None and self._matches(obj, attr, value):
+                self.hits += 1
+                return obj
+
+        self.misses += 1
+        obj = session.query(cls).filter_by(**kwargs).one_or_none()
+        if obj is not None:
+            # only a query by this key proves it matches a single row
+            self._store(session, obj, (cls, attr, value))
+        return obj
+
+    def invalidate(self, cls, pk):
+        state = self._states.pop((cls, pk), None)
+        if state is None:
+            return
+        for attr in self.natural_keys.get(cls, ()):
+            key = (cls, attr, state[attr])
+            if self._index.get(key) == pk:
+                del self._index[key]
+
+    def clear(self):
+        self._states.clear()
+        self._index.clear()
+        # invalidation records still guard rows pending in open
+        # transactions, so they are pruned, not cleared
+
+    def _load(self, session, cls, pk):
+        state = self._states.get((cls, pk))
+        if state is None:
+            return None
+        self._states.move_to_end((cls, pk))
+
+        mapper = sql.inspect(cls)
+        key = mapper.identity_key_from_primary_key(pk)
+        obj = session.identity_map.get(key)
+        if obj is not None:
+            return None if obj in session.deleted else obj
+
+        # build a detached instance from the cached columns, then attach it
+        obj = mapper.class_manager.new_instance()
+        for attr, value in state.items():
+            sql.orm.attributes.set_committed_value(obj, attr, value)
+        sql.orm.make_transient_to_detached(obj)
+        session.add(obj)
+        return obj
+
+    def _matches(self, obj, attr, value):
+        # read the instance dict only: an expired attribute would otherwise
+        # be refreshed with a SELECT and still be counted as a hit
+        loaded = sql.inspect(obj).attrs[attr].loaded_value
+        return loaded is sql.orm.attributes.NO_VALUE or loaded == value
+
+    def _store(self, session, obj, natural_key):
+        cls = type(obj)
+        if cls not in self.natural_keys:
+            return
+        # unflushed edits must never reach the cache
+        if obj in session.new or session.is_modified(obj):
+            return
+
+        mapper = sql.inspect(cls)
+        pk = tuple(mapper.primary_key_from_instance(obj))
+        state = {
+            attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs
+        }
+        pending = self._pending.setdefault(session, _Pending())
+        pending.entries.append((cls, pk, state, natural_key))
+
+    def _publish(self, cls, pk, state, natural_key):
+        # keep the natural keys already proven for this row if unchanged
+        keys = [natural_key] if natural_key is not None else []
+        old = self._states.get((cls, pk))
+        if old is not None:
+            keys += [(cls, attr, old[attr])
+                     for attr in self.natural_keys[cls]
+                     if old[attr] == state[attr] and
+                     self._index.get((cls, attr, old[attr])) == pk]
+
+        self.invalidate(cls, pk)
+        self._states[(cls, pk)] = state
+        for key in keys:
+            self._index[key] = pk
+
+        while len(self._states) > self.maxsize:
+            old_cls, old_pk = next(iter(self._states))
+            self.invalidate(old_cls, old_pk)
+            self.evictions += 1
+
+    def _after_begin(self, session, transaction, connection):
+        # fires again for savepoints and extra binds; keep the first
+        self._began.setdefault(session, self._commits)
+
+    def _after_flush(self, session, flush_context):
+        pending = self._pending.setdefault(session, _Pending())
+
+        # new, dirty and deleted still hold the pre-flush state here
+        for obj in session.new | session.dirty | session.deleted:
+            cls = type(obj)
+            if cls not in self.natural_keys:
+                continue
+            pk = sql.inspect(obj).identity
+            if pk is None:
+                pk = tuple(sql.inspect(cls).primary_key_from_instance(obj))
+            pending.invalidated.add((cls, pk))
+
+            # a new or renamed row may duplicate a cached, non-unique
+            # natural key; unloaded attributes have not changed
+            attrs = sql.inspect(obj).attrs
+            for attr in self.natural_keys[cls]:
+                value = attrs[attr].loaded_value
+                if value is not sql.orm.attributes.NO_VALUE:
+                    pending.invalidated.add((cls, attr, value))
+
+    def _after_commit(self, session):
+        # also fires when a savepoint is released; its work stays pending
+        # until the outermost transaction commits
+        if session.transaction.parent is not None:
+            return
+        pending = self._pending.pop(session, None)
+        if pending is None:
+            return
+
+        if pending.invalidated:
+            self._commits += 1
+        for key in pending.invalidated:
+            self._invalidated[key] = self._commits
+            if len(key) == 2:
+                self.invalidate(*key)
+            else:
+                pk = self._index.get(key)
+                if pk is not None:
+                    self.invalidate(key[0], pk)
+
+        # rows read by a transaction of unknown age are never published
+        began = self._began.get(session)
+        if began is None:
+            return
+        for cls, pk, state, natural_key in pending.entries:
+            keys = [(cls, pk)]
+            if natural_key is not None:
+                keys.append(natural_key)
+            if all(self._invalidated.get(key, 0) <= began for key in keys):
+                self._publish(cls, pk, state, natural_key)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        # a rolled back savepoint may have undone rows we loaded since;
+        # keep the invalidations, which are always safe to apply
+        pending = self._pending.get(session)
+        if pending is not None and previous_transaction.parent is not None:
+            pending.entries = []
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        self._pending.pop(session, None)
+        self._began.pop(session, None)
+
+        oldest = min(self._began.values(), default=self._commits)
+        for key in [key for key, commit in self._invalidated.items()
+                    if commit <= oldest]:
+            del self._invalidated[key]
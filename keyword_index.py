@@ -0,0 +1,346 @@
+import collections
+import weakref
+
+import sqlalchemy as sql
+from models import BlogPost, Keyword, post_keywords
+
+
+# read collection histories without lazy loading them mid-flush; an
+# unloaded side reports no history, the side that was changed is loaded
+_NO_LOAD = sql.orm.attributes.PASSIVE_NO_INITIALIZE
+
+# positions of the set bits in every byte value, to decode bitmaps
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1)
+              for value in range(256)]
+
+
+class _Changes:
+    """Tag changes a session has flushed in its current transaction."""
+
+    def __init__(self):
+        # keyword -> id, or None once the keyword is deleted or renamed
+        self.names = {}
+        self.linked = collections.defaultdict(set)
+        self.unlinked = collections.defaultdict(set)
+        self.new_posts = set()
+        self.deleted_posts = set()
+        self.deleted_keywords = set()
+        # a savepoint was rolled back, so the changes above are unreliable
+        self.broken = False
+
+    def link(self, keyword_id, post_id):
+        self.unlinked[keyword_id].discard(post_id)
+        self.linked[keyword_id].add(post_id)
+
+    def unlink(self, keyword_id, post_id):
+        self.linked[keyword_id].discard(post_id)
+        self.unlinked[keyword_id].add(post_id)
+
+    def delete_post(self, post_id):
+        self.new_posts.discard(post_id)
+        self.deleted_posts.add(post_id)
+        for post_ids in self.linked.values():
+            post_ids.discard(post_id)
+
+    def delete_keyword(self, keyword_id):
+        self.deleted_keywords.add(keyword_id)
+        self.linked.pop(keyword_id, None)
+        self.unlinked.pop(keyword_id, None)
+
+
+class KeywordIndex:
+    """In-memory posting lists from keyword to ``BlogPost`` ids.
+
+    Answers boolean tag queries such as "tagged A and B but not C" without
+    the correlated ``EXISTS`` subqueries that ``BlogPost.keywords.any()``
+    compiles to. The lists are built from ``post_keywords`` on the first
+    query that can only see committed rows. Tag changes flushed by a
+    session are visible to that session right away and are merged into the
+    shared lists when its outermost transaction commits, or dropped when it
+    rolls back.
+
+    With ``bitmap=True`` each posting list is a Python integer with one bit
+    per post id, which makes intersections cheap for dense tags.
+    """
+
+    def __init__(self, bitmap=False):
+        self.bitmap = bitmap
+        self._keyword_ids = {}
+        self._keyword_names = {}
+        self._postings = {}
+        self._all_posts = self._empty()
+        self._changes = weakref.WeakKeyDictionary()
+        # commits that changed tags, and how many there were when each
+        # open transaction began
+        self._commits = 0
+        self._began = weakref.WeakKeyDictionary()
+        self._stale = True
+
+    def install(self, target):
+        """Listen for transaction events on a session or sessionmaker."""
+        for name, fn in self._events():
+            sql.event.listen(target, name, fn)
+
+    def uninstall(self, target):
+        """Stop listening for transaction events on ``target``."""
+        for name, fn in self._events():
+            sql.event.remove(target, name, fn)
+
+    def _events(self):
+        return [
+            ('after_begin', self._after_begin),
+            ('after_flush', self._after_flush),
+            ('after_commit', self._after_commit),
+            ('after_soft_rollback', self._after_soft_rollback),
+            ('after_transaction_end', self._after_transaction_end),
+        ]
+
+    def build(self, session):
+        self._keyword_ids = dict(
+            session.query(Keyword.keyword, Keyword.id).all()
+        )
+        self._keyword_names = {
+            keyword_id: keyword
+            for keyword, keyword_id in self._keyword_ids.items()
+        }
+        postings = collections.defaultdict(set)
+        for post_id, keyword_id in session.execute(
+                sql.select([post_keywords.c.post_id,
+                            post_keywords.c.keyword_id])):
+            postings[keyword_id].add(post_id)
+        self._postings = {
+            keyword_id: self._from_ids(post_ids)
+            for keyword_id, post_ids in postings.items()
+        }
+        self._all_posts = self._from_ids(
+            post_id for post_id, in session.query(BlogPost.id)
+        )
+        self._stale = False
+
+    def _sees_committed_only(self, session):
+        # no uncommitted tag changes of its own, and no other session
+        # committed any since its snapshot may have been taken
+        return (session not in self._changes and
+                self._began.get(session) == self._commits)
+
+    def post_ids(self, session, all_of=(), any_of=(), none_of=()):
+        """Ids of the posts tagged with every keyword in ``all_of``, at
+        least one keyword in ``any_of`` (when given) and none of the
+        keywords in ``none_of``, in ascending order.
+        """
+        if session.autoflush:
+            session.flush()
+        if self._stale:
+            # begin the transaction so after_begin records its baseline
+            session.connection(mapper=BlogPost)
+            if not self._sees_committed_only(session):
+                # answer from private lists; sharing them would leak rows
+                # other sessions must not see, or miss ones they must
+                index = KeywordIndex(bitmap=self.bitmap)
+                index.build(session)
+                return index._evaluate(None, all_of, any_of, none_of)
+            self.build(session)
+        return self._evaluate(self._changes.get(session),
+                              all_of, any_of, none_of)
+
+    def _evaluate(self, changes, all_of, any_of, none_of):
+        result = self._all_posts
+        if changes is not None and changes.deleted_posts:
+            result = self._minus(result, self._from_ids(changes.deleted_posts))
+        if changes is not None and changes.new_posts:
+            result = result | self._from_ids(changes.new_posts)
+        for keyword in all_of:
+            result = result & self._posting(keyword, changes)
+        if any_of:
+            union = self._empty()
+            for keyword in any_of:
+                union = union | self._posting(keyword, changes)
+            result = result & union
+        for keyword in none_of:
+            result = self._minus(result, self._posting(keyword, changes))
+        return self._to_list(result)
+
+    def posts(self, session, all_of=(), any_of=(), none_of=()):
+        """Same as :meth:`post_ids`, loading the ``BlogPost`` objects in
+        a single query.
+        """
+        ids = self.post_ids(session, all_of, any_of, none_of)
+        if not ids:
+            return []
+        return session.query(BlogPost)\
+                      .filter(BlogPost.id.in_(ids))\
+                      .order_by(BlogPost.id)\
+                      .all()
+
+    def _posting(self, keyword, changes):
+        if changes is None:
+            keyword_id = self._keyword_ids.get(keyword)
+            return self._postings.get(keyword_id, self._empty())
+
+        # overlay the session's own uncommitted changes
+        if keyword in changes.names:
+            keyword_id = changes.names[keyword]
+        else:
+            keyword_id = self._keyword_ids.get(keyword)
+        if keyword_id is None:
+            return self._empty()
+
+        posting = self._empty()
+        if keyword_id not in changes.deleted_keywords:
+            posting = self._postings.get(keyword_id, posting)
+        removed = changes.deleted_posts | changes.unlinked.get(keyword_id,
+                                                               set())
+        posting = self._minus(posting, self._from_ids(removed))
+        return posting | self._from_ids(changes.linked.get(keyword_id, ()))
+
+    def _empty(self):
+        return 0 if self.bitmap else set()
+
+    def _from_ids(self, post_ids):
+        if not self.bitmap:
+            return set(post_ids)
+        post_ids = list(post_ids)
+        if not post_ids:
+            return 0
+        # set the bits in a byte buffer, then convert once
+        bits = bytearray(max(post_ids) // 8 + 1)
+        for post_id in post_ids:
+            bits[post_id >> 3] |= 1 << (post_id & 7)
+        return int.from_bytes(bits, 'little')
+
+    def _minus(self, posting, other):
+        return posting & ~other if self.bitmap else posting - other
+
+    def _to_list(self, posting):
+        if not self.bitmap:
+            return sorted(posting)
+        ids = []
+        data = posting.to_bytes((posting.bit_length() + 7) // 8, 'little')
+        for offset, byte in enumerate(data):
+            if byte:
+                ids.extend(offset * 8 + bit for bit in _BYTE_BITS[byte])
+        return ids
+
+    def _apply(self, changes):
+        if changes.deleted_posts:
+            deleted = self._from_ids(changes.deleted_posts)
+            self._all_posts = self._minus(self._all_posts, deleted)
+            for keyword_id, posting in self._postings.items():
+                if self.bitmap:
+                    self._postings[keyword_id] = posting & ~deleted
+                else:
+                    posting -= deleted
+
+        for keyword_id in changes.deleted_keywords:
+            self._postings.pop(keyword_id, None)
+            self._keyword_ids.pop(self._keyword_names.pop(keyword_id, None),
+                                  None)
+        for keyword, keyword_id in changes.names.items():
+            if keyword_id is None:
+                old_id = self._keyword_ids.pop(keyword, None)
+                if self._keyword_names.get(old_id) == keyword:
+                    del self._keyword_names[old_id]
+            else:
+                self._keyword_ids[keyword] = keyword_id
+                self._keyword_names[keyword_id] = keyword
+
+        for keyword_id, post_ids in changes.unlinked.items():
+            if keyword_id in self._postings:
+                self._update(keyword_id, post_ids, linked=False)
+        for keyword_id, post_ids in changes.linked.items():
+            self._update(keyword_id, post_ids, linked=True)
+
+        if self.bitmap:
+            self._all_posts |= self._from_ids(changes.new_posts)
+        else:
+            self._all_posts |= changes.new_posts
+
+    def _update(self, keyword_id, post_ids, linked):
+        if not post_ids:
+            return
+        posting = self._postings.get(keyword_id)
+        if posting is None:
+            posting = self._postings[keyword_id] = self._empty()
+        if self.bitmap:
+            ids = self._from_ids(post_ids)
+            self._postings[keyword_id] = (posting | ids if linked
+                                          else posting & ~ids)
+        elif linked:
+            posting |= post_ids
+        else:
+            posting -= post_ids
+
+    def _after_begin(self, session, transaction, connection):
+        # fires again for savepoints and extra binds; keep the first
+        self._began.setdefault(session, self._commits)
+
+    def _after_flush(self, session, flush_context):
+        changes = self._changes.setdefault(session, _Changes())
+
+        # new, dirty and deleted still hold the pre-flush state here, and
+        # the collection histories have not been reset yet
+        for obj in session.new:
+            if isinstance(obj, Keyword):
+                changes.names[obj.keyword] = obj.id
+            elif isinstance(obj, BlogPost):
+                changes.new_posts.add(obj.id)
+
+        for obj in session.new | session.dirty:
+            if isinstance(obj, BlogPost):
+                history = sql.orm.attributes.get_history(
+                    obj, 'keywords', _NO_LOAD)
+                for keyword in history.added or ():
+                    changes.link(keyword.id, obj.id)
+                for keyword in history.deleted or ():
+                    changes.unlink(keyword.id, obj.id)
+            elif isinstance(obj, Keyword):
+                history = sql.orm.attributes.get_history(
+                    obj, 'posts', _NO_LOAD)
+                for post in history.added or ():
+                    changes.link(obj.id, post.id)
+                for post in history.deleted or ():
+                    changes.unlink(obj.id, post.id)
+                renamed = sql.orm.attributes.get_history(obj, 'keyword')
+                for old in renamed.deleted or ():
+                    changes.names[old] = None
+                for new in renamed.added or ():
+                    changes.names[new] = obj.id
+
+        for obj in session.deleted:
+            if isinstance(obj, Keyword):
+                changes.delete_keyword(obj.id)
+                for keyword, keyword_id in list(changes.names.items()):
+                    if keyword_id == obj.id:
+                        changes.names[keyword] = None
+                name = self._keyword_names.get(obj.id)
+                if name is not None:
+                    changes.names.setdefault(name, None)
+            elif isinstance(obj, BlogPost):
+                changes.delete_post(obj.id)
+
+    def _after_commit(self, session):
+        # also fires when a savepoint is released; its changes stay with
+        # the enclosing transaction until the outermost one commits
+        if session.transaction.parent is not None:
+            return
+        changes = self._changes.pop(session, None)
+        if changes is None:
+            return
+        self._commits += 1
+        if self._stale:
+            return
+        if changes.broken:
+            self._stale = True
+        else:
+            self._apply(changes)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        changes = self._changes.get(session)
+        if changes is not None and previous_transaction.parent is not None:
+            changes.broken = True
+
+    def _after_transaction_end(self, session, transaction):
+        if transaction.parent is not None:
+            return
+        self._changes.pop(session, None)
+        self._began.pop(session, None)
@@ -1,5 +1,7 @@
 import sqlalchemy as sql
 from models import Base, Address, User, BlogPost, Keyword
+from cache import IdentityCache
+from keyword_index import KeywordIndex
 
 
 def create_engines_and_sessions():
@@ -487,6 +489,65 @@ def many_to_many(session):
     print("Wendy's posts: {}".format(wendy.posts.all()))
 
 
+def tag_queries(session):
+    index = KeywordIndex(bitmap=True)
+    index.install(session)
+
+    # the first query builds the posting lists from post_keywords
+    print('posts tagged firstpost: {}'.format(
+        index.posts(session, all_of=['firstpost'])
+    ))
+
+    # flushing new tags updates the index in place
+    wendy = session.query(User).filter_by(name='wendy').one()
+    post = BlogPost("Wendy's Second Post", "Another test", wendy)
+    post.keywords.append(session.query(Keyword)
+                                .filter_by(keyword='wendy')
+                                .one())
+    post.keywords.append(Keyword('secondpost'))
+    session.add(post)
+
+    # posts tagged 'wendy' AND NOT 'firstpost'
+    print('wendy posts except the first: {}'.format(
+        index.posts(session, all_of=['wendy'], none_of=['firstpost'])
+    ))
+
+    # ids of posts tagged 'firstpost' OR 'secondpost'
+    print('first or second post ids: {}'.format(
+        index.post_ids(session, any_of=['firstpost', 'secondpost'])
+    ))
+
+    # stop tracking the long-lived session's flushes
+    index.uninstall(session)
+
+
+def second_level_cache(session_class):
+    cache = IdentityCache(maxsize=16)
+    cache.install(session_class)
+
+    # the first lookup by name hits the database...
+    session = session_class()
+    wendy_id = cache.get_by(session, User, name='wendy').id
+    keyword_id = cache.get_by(session, Keyword, keyword='firstpost').id
+    # ...and is shared with other sessions once the transaction commits
+    session.commit()
+    session.close()
+
+    # ...later sessions rehydrate the cached rows without SQL
+    session = session_class()
+    print('cached wendy =', cache.get_by(session, User, name='wendy'))
+    print('cached wendy by id =', cache.get(session, User, wendy_id))
+    print('cached keyword =', cache.get(session, Keyword, keyword_id).keyword)
+
+    # committing a change drops the stale entry
+    session.query(User).filter_by(name='wendy').one().nickname = 'wendz'
+    session.commit()
+    print('wendy after commit =', cache.get_by(session, User, name='wendy'))
+    session.close()
+
+    print('cache stats =', cache.stats())
+
+
 def main():
     # Check SQLAlchemy version
     print('SQLAlchemy version: {}'.format(sql.__version__))
@@ -598,6 +659,14 @@ def main():
 
         session.commit()
 
+        # Boolean tag queries with an in-memory keyword index
+        tag_queries(session)
+
+        session.commit()
+
+        # Cache hot lookups across sessions
+        second_level_cache(session_class)
+
 
 if __name__ == '__main__':
     main()